@@ -3,22 +3,236 @@
 # flake8: noqa
 from __future__ import print_function
 
+import collections.abc
+import contextlib
 import json
 import logging
+import mmap
 import os
 import re
 import shlex
+import shutil
+import stat
 import subprocess
 import sys
+import threading
 import time
 
 import jsonschema
 import yaml
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+try:
+    from yaml import CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeDumper as _Dumper
+
+
+logger = logging.getLogger('control')
+
+# CONTROL_SKIP_VALIDATE=1 (or --no-validate) skips schema validation
+_VALIDATE = os.environ.get('CONTROL_SKIP_VALIDATE') != '1'
+
+_ENV_VAR_RE = re.compile(r'\{([^}]+)\}')
+
+# interpreters for scripts that are not executable themselves
+_INTERP = {'.js': 'node', '.py': 'python'}
+
+# deletes the control characters that need escaping in unit files
+_CTRL_TABLE = str.maketrans('', '', ''.join(
+    chr(i) for i in list(range(0x00, 0x20)) + list(range(0x7f, 0xa0))))
+
+# unit file states for which `systemctl is-enabled` succeeds
+_ENABLED_STATES = ('enabled', 'enabled-runtime', 'alias', 'static', 'indirect',
+                   'generated', 'transient')
+
+_which_cache = {}
+
+
+def _cached_which(name):
+    # services commonly share interpreters (node, python), look each up once
+    path = os.environ.get('PATH')
+    key = (name, path)
+    if key not in _which_cache:
+        _which_cache[key] = shutil.which(name, path=path)
+    return _which_cache[key]
+
+
+_realpath_cache = {}
+
+
+def _realpath(base, path):
+    # services share interpreters and working directories, resolve each once
+    key = (base, path)
+    if key not in _realpath_cache:
+        _realpath_cache[key] = os.path.realpath(os.path.join(base, path))
+    return _realpath_cache[key]
+
+
+_probe_cache = {}
+
+
+def _probe(path):
+    """Return (is regular file, has an executable bit) with one stat per path."""
+    if path not in _probe_cache:
+        try:
+            st = os.stat(path)
+            _probe_cache[path] = (stat.S_ISREG(st.st_mode), bool(st.st_mode & 0o111))
+        except OSError:
+            _probe_cache[path] = (False, False)
+    return _probe_cache[path]
+
+
+_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'number': (int, float),
+    'boolean': bool,
+}
+
+
+_COMPILED_KEYWORDS = frozenset([
+    'type', 'enum', 'required', 'properties', 'additionalProperties', 'items',
+    'allOf', 'oneOf',
+])
+
+
+def _compile(schema):
+    """Turn one of the static schemas below into a plain check function.
+
+    Only the keywords used by this module are compiled, for any other
+    validation keyword a prebuilt jsonschema validator is used instead.
+    Non-keywords are ignored, just like jsonschema does.
+    """
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    if any(i in cls.VALIDATORS and i not in _COMPILED_KEYWORDS for i in schema):
+        return cls(schema).validate
+    checks = []
+
+    if 'type' in schema:
+        name = schema['type']
+        types = _TYPES[name]
+        strict = name in ('number', 'array', 'object')
+
+        def check_type(data):
+            if not isinstance(data, types) or (strict and isinstance(data, bool)):
+                raise jsonschema.ValidationError('%r is not of type %r' % (data, name))
+        checks.append(check_type)
+
+    if 'enum' in schema and len(schema['enum']) == 1:
+        # single value enums like version are a plain comparison
+        (value, ) = schema['enum']
+
+        def check_enum(data):
+            if data != value:
+                raise jsonschema.ValidationError('%r is not one of %r' % (data, [value]))
+        checks.append(check_enum)
+    elif 'enum' in schema:
+        values = schema['enum']
+
+        def check_enum(data):
+            if data not in values:
+                raise jsonschema.ValidationError('%r is not one of %r' % (data, values))
+        checks.append(check_enum)
+
+    if 'required' in schema:
+        required = schema['required']
+
+        def check_required(data):
+            if isinstance(data, dict):
+                for key in required:
+                    if key not in data:
+                        raise jsonschema.ValidationError('%r is a required property' % (key, ))
+        checks.append(check_required)
+
+    if 'properties' in schema:
+        properties = dict((k, _compile(v)) for (k, v) in schema['properties'].items())
+
+        def check_properties(data):
+            if isinstance(data, dict):
+                for (key, check) in properties.items():
+                    if key in data:
+                        check(data[key])
+        checks.append(check_properties)
+
+    if 'additionalProperties' in schema:
+        known = schema.get('properties', {})
+        additional = _compile(schema['additionalProperties'])
+
+        def check_additional(data):
+            if isinstance(data, dict):
+                for (key, value) in data.items():
+                    if key not in known:
+                        additional(value)
+        checks.append(check_additional)
+
+    if 'items' in schema:
+        items = _compile(schema['items'])
+
+        def check_items(data):
+            if isinstance(data, list):
+                for value in data:
+                    items(value)
+        checks.append(check_items)
+
+    if 'allOf' in schema:
+        checks.extend(_compile(i) for i in schema['allOf'])
+
+    if 'oneOf' in schema:
+        one_of = [_compile(i) for i in schema['oneOf']]
+
+        def check_one_of(data):
+            matched = 0
+            for check in one_of:
+                try:
+                    check(data)
+                    matched += 1
+                except jsonschema.ValidationError:
+                    pass
+            if matched != 1:
+                raise jsonschema.ValidationError(
+                    '%r is not valid under exactly one of the given schemas' % (data, ))
+        checks.append(check_one_of)
+
+    def validate(data):
+        for check in checks:
+            check(data)
+    return validate
+
+
+class _LazyDict(collections.abc.Mapping):
+    """Read-only mapping over keys, values are computed by func on access."""
+
+    def __init__(self, keys, func):
+        self._keys = keys
+        self._func = func
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._func(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '{%s}' % (', '.join('%r: ...' % (k, ) for k in self._keys), )
+
 
 class Executable:
     """Executable."""
 
+    __slots__ = ('args', 'env', 'cwd')
+
     schema = {
         'type': 'object',
         'properties': {
@@ -36,6 +250,8 @@ class Executable:
         ],
     }
 
+    _validate = staticmethod(_compile(schema))
+
     def __init__(self):
         self.args = None
         self.env = None
@@ -55,54 +271,71 @@ class Executable:
         return repr(self.to_dict())
 
     def parse_dict(self, data):
-        jsonschema.validate(data, self.schema)
+        if _VALIDATE:
+            self._validate(data)
+        self._parse_dict_noschema(data)
 
+    def _parse_dict_noschema(self, data):
+        # data is left untouched, callers can pass the raw config dict
         if 'run' in data:
-            self.args = shlex.split(data.pop('run'))
+            self.args = shlex.split(data['run'])
 
         if 'shell' in data:
             assert self.args is None
-            self.args = ['/bin/sh', '-c', data.pop('shell')]
+            self.args = ['/bin/sh', '-c', data['shell']]
 
         if 'cmd' in data:
             assert self.args is None
-            self.args = [data.pop('cmd')] + data.pop('args', [])
+            self.args = [data['cmd']] + data.get('args', [])
 
+        base = os.getcwd()
         if 'cwd' in data:
-            self.cwd = os.path.realpath(data.pop('cwd'))
+            self.cwd = _realpath(base, data['cwd'])
             assert isinstance(self.cwd, str)
 
         if 'env' in data:
-            self.env = data.pop('env')
+            self.env = data['env']
             assert isinstance(self.env, dict)
 
         assert self.args and len(self.args) >= 1
 
         def resolve(path):
-            return os.path.realpath(os.path.join(self.cwd if self.cwd else '.', path))
+            return _realpath(self.cwd or base, path)
 
-        if not os.access(resolve(self.args[0]), os.X_OK) and self.args[0].endswith('.js'):
-            self.args = ['node'] + self.args
-        if not os.access(resolve(self.args[0]), os.X_OK) and self.args[0].endswith('.py'):
-            self.args = ['python'] + self.args
+        # only resolve / stat again when args[0] was rewritten
+        resolved = resolve(self.args[0])
+        (is_file, is_exec) = _probe(resolved)
 
-        if not os.path.isfile(resolve(self.args[0])) and '/' not in self.args[0]:
-            try:
-                tmp = subprocess.check_output(['which', self.args[0]]).strip()
-                self.args[0] = tmp.decode('utf-8')
-            except:
-                pass
+        interp = None if is_exec else _INTERP.get(
+            os.path.splitext(self.args[0])[1])
+        if interp:
+            self.args = [interp] + self.args
+            resolved = resolve(self.args[0])
+            (is_file, is_exec) = _probe(resolved)
+
+        if not is_file and '/' not in self.args[0]:
+            # misses are cached too, report them right away
+            tmp = _cached_which(self.args[0])
+            assert tmp, 'not found in PATH: {}'.format(self.args[0])
+            self.args[0] = tmp
+            resolved = resolve(self.args[0])
+            (is_file, is_exec) = _probe(resolved)
 
-        self.args[0] = resolve(self.args[0])
+        self.args[0] = resolved
 
         # @TODO: really?
-        assert os.path.isfile(resolve(self.args[0])), 'does not exist: {}'.format(
-            resolve(self.args[0]))
-        assert os.access(resolve(self.args[0]), os.X_OK), 'not executable: {}'.format(
-            resolve(self.args[0]))
+        assert is_file, 'does not exist: {}'.format(resolved)
+        assert is_exec, 'not executable: {}'.format(resolved)
 
 
 class Service(Executable):
+    __slots__ = (
+        'user', 'type', 'systemd', 'systemd_timer', 'interval', 'first_interval',
+        'random_delay', 'cron', 'max_cpu', 'max_memory', 'max_time', 'nofile',
+        'syslog', 'name', 'config', 'unit_base', 'unit_service', 'unit_timer',
+        '_exec_start', '_working_dir',
+    )
+
     schema = {
         'allOf': [
             Executable.schema,
@@ -130,6 +363,12 @@ class Service(Executable):
         ],
     }
 
+    _validate = staticmethod(_compile(schema))
+
+    # keys consumed by parse_dict, Config.materialize reports anything else
+    fields = frozenset(Executable.schema['properties']) | frozenset(
+        schema['allOf'][1]['properties'])
+
     def __init__(self, config, name):
         super().__init__()
         self.user = None
@@ -147,6 +386,11 @@ class Service(Executable):
         self.syslog = False
         self.name = name
         self.config = config
+        self.unit_base = None
+        self.unit_service = None
+        self.unit_timer = None
+        self._exec_start = None
+        self._working_dir = None
 
     def to_dict(self):
         res = super().to_dict()
@@ -181,23 +425,40 @@ class Service(Executable):
     def __repr__(self):
         return repr(self.to_dict())
 
+    @property
+    def exec_start(self):
+        if self._exec_start is None:
+            self._exec_start = ' '.join(shlex.quote(i) for i in self.args)
+        return self._exec_start
+
+    @property
+    def working_dir(self):
+        if self._working_dir is None:
+            self._working_dir = os.path.realpath(
+                self.cwd or os.path.dirname(self.config.path))
+        return self._working_dir
+
     def parse_dict(self, data):
-        jsonschema.validate(data, self.schema)
-        super().parse_dict(data)
-        self.user = data.pop('user', None)
-        self.type = data.pop('type', None)
-        self.systemd = data.pop('systemd', None)
-        self.systemd_timer = data.pop('systemd_timer', None)
-        self.interval = data.pop('interval', None)
-        self.first_interval = data.pop('first_interval', None)
-        self.random_delay = data.pop('random_delay', None)
-        self.cron = data.pop('cron', None)
-        self.max_cpu = data.pop('max_cpu', None)
-        self.max_memory = data.pop('max_memory', None)
-        self.max_time = data.pop('max_time', None)
-        self.nofile = data.pop('nofile', None)
-        self.syslog = data.pop('syslog', None)
-        return data
+        # Service.schema includes Executable.schema, validate only once
+        if _VALIDATE:
+            self._validate(data)
+        self._parse_dict_noschema(data)
+        self.user = data.get('user', None)
+        self.type = data.get('type', None)
+        self.systemd = data.get('systemd', None)
+        self.systemd_timer = data.get('systemd_timer', None)
+        self.interval = data.get('interval', None)
+        self.first_interval = data.get('first_interval', None)
+        self.random_delay = data.get('random_delay', None)
+        self.cron = data.get('cron', None)
+        self.max_cpu = data.get('max_cpu', None)
+        self.max_memory = data.get('max_memory', None)
+        self.max_time = data.get('max_time', None)
+        self.nofile = data.get('nofile', None)
+        self.syslog = data.get('syslog', None)
+        self.unit_base = self.config.name + '-' + self.name
+        self.unit_service = self.unit_base + '.service'
+        self.unit_timer = self.unit_base + '.timer'
 
     @classmethod
     def from_dict(self, config, name, data):
@@ -237,64 +498,90 @@ class Config:
         },
     }
 
+    _validate = staticmethod(_compile(schema))
+
     def __init__(self):
         self.version = None
         self.name = None
         self.path = None
         self.services = {}
+        self.raw_services = {}
         self.groups = {}
+        self.filter_index = {}
         self.env = {}
 
     def to_dict(self):
+        """Like to_full_dict, but services are only parsed and converted on access."""
         res = {}
         res['version'] = self.version
         res['name'] = self.name
         res['path'] = self.path  # ?
-        res['services'] = {}
-        for k, v in self.services.items():
-            res['services'][k] = v.to_dict()
+        res['services'] = _LazyDict(
+            self.raw_services, lambda k: self.get_service(k).to_dict())
         res['groups'] = self.groups
         res['env'] = self.env
         return res
 
+    def to_full_dict(self):
+        res = self.to_dict()
+        res['services'] = dict(res['services'])
+        return res
+
     def __repr__(self):
         return repr(self.to_dict())
         # return repr(self.__dict__)
 
     def parse_dict(self, data):
-        jsonschema.validate(data, self.schema)
+        if _VALIDATE:
+            self._validate(data)
         for (k, v) in data.pop('env', {}).items():
-            self.env[k] = str(v)
-
-        def env_subst(data):
-            if isinstance(data, list):
-                return [env_subst(i) for i in data]
-            elif isinstance(data, dict):
-                return dict((k, env_subst(v)) for (k, v) in data.items())
-            elif isinstance(data, str):
-                for i in re.findall(r'{[^}]+}', data):
-                    if i[1:-1] in self.env:
-                        data = data.replace(i, self.env[i[1:-1]])
-                    else:
-                        print('WARNING: unknown variable %s' % (i, ))
-                return data
-            else:
-                return data
-        data = env_subst(data)
+            # substitutions hand out this same object, interned for sharing
+            self.env[k] = sys.intern(str(v))
+
+        warned = set()
+
+        def env_repl(match):
+            if match.group(1) in self.env:
+                return self.env[match.group(1)]
+            # report each unknown variable once per config
+            if match.group(1) not in warned:
+                warned.add(match.group(1))
+                logger.warning('unknown variable %s', match.group(0))
+            return match.group(0)
+
+        # yaml aliases share nodes, give every reference its own copy first so
+        # services (and dump) get independent values, like they used to
+        todo = [data]
+        seen = set([id(data)])
+        while todo:
+            node = todo.pop()
+            items = node.items() if isinstance(node, dict) else enumerate(node)
+            for (k, v) in items:
+                if isinstance(v, (dict, list)):
+                    if id(v) in seen:
+                        v = node[k] = dict(v) if isinstance(v, dict) else list(v)
+                    seen.add(id(v))
+                    todo.append(v)
+
+        # substitute in place, data is freshly loaded and owned by us
+        todo = [data]
+        while todo:
+            node = todo.pop()
+            items = node.items() if isinstance(node, dict) else enumerate(node)
+            for (k, v) in items:
+                if isinstance(v, str):
+                    if '{' in v:
+                        node[k] = _ENV_VAR_RE.sub(env_repl, v)
+                elif isinstance(v, (dict, list)):
+                    todo.append(v)
 
         self.version = data.pop('version')
         self.name = data.pop('name')
         # res.path = os.path.realpath(path) if path else None
-        for (key, value) in data.pop('services', {}).items():
-            tmp = value.copy()
-            service = Service.from_dict(self, key, tmp)
-            # service = Service(self, key)
-            # tmp = service.parse_dict(value.copy())
-            if len(tmp.keys()):
-                print('WARNING: service %s has additional keys %r' %
-                      (key, list(tmp.keys())))
-            self.services[key] = service
+        # services are parsed on first use, see materialize()
+        self.raw_services = data.pop('services', {})
         self.groups = data.pop('groups', {})
+        self.build_filter_index()
         if len(data.keys()):
             print('WARNING: configuration has additional keys %r' %
                   list(data.keys()), )
@@ -308,11 +595,36 @@ class Config:
 
     @classmethod
     def load(self, path):
-        with open(path, 'r') as fp:
-            data = yaml.load(fp, Loader=yaml.SafeLoader)
+        # hand libyaml the mapped bytes, it decodes utf-8 itself
+        with open(path, 'rb') as fp:
+            try:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # pipes and empty files cannot be mapped, read them normally
+                data = yaml.load(fp, Loader=_Loader)
+            else:
+                with mm:
+                    data = yaml.load(mm, Loader=_Loader)
         return self.from_dict(data, path)
 
+    def materialize(self, names=None):
+        """Parse the service definitions for names (or all) if not done yet."""
+        if names is None:
+            names = self.raw_services.keys()
+        for key in names:
+            if key in self.services or key not in self.raw_services:
+                continue
+            value = self.raw_services[key]
+            service = Service.from_dict(self, key, value)
+            # service = Service(self, key)
+            # tmp = service.parse_dict(value)
+            tmp = [i for i in value.keys() if i not in Service.fields]
+            if len(tmp):
+                print('WARNING: service %s has additional keys %r' % (key, tmp))
+            self.services[key] = service
+
     def get_service(self, name):
+        self.materialize([name])
         return self.services.get(name, None)
 
     def get_services(self, filter):
@@ -322,52 +634,172 @@ class Config:
                 res += self.get_services(i)
             return res
 
-        if filter == 'all':
-            return self.services.values()
-
-        if filter in self.services:
-            return [self.services[filter]]
-
-        if filter in self.groups:
-            return self.get_services(self.groups[filter])
-
-        else:
+        return [self.get_service(i) for i in self.filter_index.get(filter, [])]
+
+    def build_filter_index(self):
+        """Map 'all', service and (flattened) group names to service names."""
+        def expand(name, seen):
+            if name == 'all':
+                return list(self.raw_services)
+            if name in self.raw_services:
+                return [name]
+            if name in self.groups and name not in seen:
+                res = []
+                for i in self.groups[name]:
+                    res += expand(i, seen + (name, ))
+                return res
             return []
 
+        index = {}
+        for name in self.groups:
+            index[name] = expand(name, ())
+        for name in self.raw_services:
+            index[name] = [name]
+        index['all'] = list(self.raw_services)
+        self.filter_index = index
+
+
+def _unique(services):
+    """Drop repeated services (overlapping filters/groups), keeping order."""
+    seen = set()
+    res = []
+    for service in services:
+        if service.name not in seen:
+            seen.add(service.name)
+            res.append(service)
+    return res
+
+
+# runs as root during SystemD.batch(), reads "<path> <size>\n<data>" records
+_WRITE_HELPER = """
+import os, sys
+while True:
+    line = sys.stdin.buffer.readline()
+    if not line:
+        break
+    (path, size) = line.decode('utf-8').rstrip('\\n').rsplit(' ', 1)
+    data = sys.stdin.buffer.read(int(size))
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(data)
+    os.replace(path + '.tmp', path)
+    sys.stdout.write('ok\\n')
+    sys.stdout.flush()
+"""
+
 
 class SystemD:
     unit_path = '/etc/systemd/system/'
+    _systemd_version = None
+    _systemd_version_lock = threading.Lock()
+
+    def __init__(self):
+        self._is_root = os.geteuid() == 0
+        self._valid_calendars = set()
+        self._batch = False
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def begin_batch(self):
+        """Send file_write through one sudo helper process until end_batch().
+
+        The helper is only started for the first file that needs writing. If
+        sudo does not allow running it, file_write falls back to one
+        `sudo tee` per file.
+        """
+        self._batch = not self._is_root
+
+    def end_batch(self):
+        with self._writer_lock:
+            self._batch = False
+            if self._writer is not None:
+                returncode = self._stop_writer()
+                if returncode != 0:
+                    logger.warning('write helper exited with %d', returncode)
+
+    def _stop_writer(self):
+        # called with _writer_lock held, returns the exit status
+        writer = self._writer
+        self._writer = None
+        try:
+            writer.stdin.close()
+        except OSError:
+            pass
+        return writer.wait()
+
+    def _helper_write(self, path, data):
+        """Write data through the batch helper, returns False if there is none."""
+        with self._writer_lock:
+            if not self._batch:
+                return False
+            header = '%s %d\n' % (path, len(data))
+            try:
+                if self._writer is None:
+                    self._writer = subprocess.Popen(
+                        ['sudo', '-n', sys.executable, '-c', _WRITE_HELPER],
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL)
+                self._writer.stdin.write(header.encode('utf-8') + data)
+                self._writer.stdin.flush()
+                if self._writer.stdout.readline() == b'ok\n':
+                    return True
+            except OSError:
+                pass
+            # sudo refused or the helper died, use tee for the rest of the batch
+            logger.debug('write helper failed, falling back to sudo tee')
+            self._batch = False
+            if self._writer is not None:
+                self._stop_writer()
+            return False
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
 
     def file_write(self, path, content):
+        """Write content to path, returns False if it was already up to date."""
+        data = content.encode('utf-8')
         try:
-            if self.file_read(path) == content:
-                return
-        except:
+            # only read back files that can be equal
+            if os.stat(path).st_size == len(data):
+                with open(path, 'rb') as fp:
+                    if fp.read() == data:
+                        return False
+        except OSError:
             pass
         print('updating', path)
-        if os.geteuid() == 0:
-            with open(path, 'w') as fp:
-                fp.write(content)
-        else:
+        if self._is_root:
+            # write next to the target and rename, never leaves a partial unit file
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp, path)
+        elif not self._helper_write(path, data):
             proc = subprocess.Popen(
                 ['sudo', '-n', 'tee', path], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
-            proc.communicate(content.encode('utf-8'))
+            proc.communicate(data)
             proc.wait()
+        return True
 
     def file_read(self, path):
         with open(path, 'r') as fp:
             return fp.read()
 
     def file_delete(self, path):
-        if not os.path.exists(path):
-            return
-        if os.geteuid() == 0:
-            os.unlink(path)
-        else:
-            subprocess.call(['sudo', '-n', 'rm', path])
+        if self._is_root:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        elif os.path.exists(path):
+            # a stat is still much cheaper than running sudo for nothing
+            subprocess.call(['sudo', '-n', 'rm', '-f', path])
 
     def run(self, args, silent=False):
-        if os.geteuid() != 0:
+        if not self._is_root:
             args = ['sudo', '-n'] + args
         kwargs = {}
         if silent:
@@ -375,16 +807,43 @@ class SystemD:
             kwargs['stderr'] = subprocess.DEVNULL
         subprocess.check_call(args, **kwargs)
 
+    def popen(self, args, **kwargs):
+        """Start args like run() without waiting for it."""
+        if not self._is_root:
+            args = ['sudo', '-n'] + args
+        return subprocess.Popen(args, **kwargs)
+
+    def query(self, args, lines=None):
+        """Run args like run() but return stdout, the exit code is ignored.
+
+        Raises CalledProcessError if lines is given and stdout has a different
+        number of lines, or if sudo itself failed.
+        """
+        if not self._is_root:
+            args = ['sudo', '-n'] + args
+        proc = subprocess.run(args, stdout=subprocess.PIPE)
+        res = proc.stdout.decode('utf-8')
+        if lines is not None and len(res.splitlines()) != lines:
+            raise subprocess.CalledProcessError(proc.returncode, args, proc.stdout)
+        if proc.returncode != 0 and not res and not self._is_root:
+            # tell "nothing listed" apart from sudo refusing to run the command
+            subprocess.check_call(['sudo', '-n', 'true'])
+        return res
+
     def quote(self, s):
         # escape for systemd
-        if not re.search('[\x00-\x1f\x7f-\x9f]', s):
+        if s.translate(_CTRL_TABLE) == s:
             return s
         # repr pretty much matches systemd escaping.. but verify this
         return repr(s)
 
     def systemd_version(self):
-        tmp = subprocess.check_output(['systemd', '--version'])
-        return int(tmp.decode('utf-8').split('\n')[0].split(' ')[1])
+        # once per process, even if called from several threads at once
+        with SystemD._systemd_version_lock:
+            if SystemD._systemd_version is None:
+                tmp = subprocess.check_output(['systemd', '--version'])
+                SystemD._systemd_version = int(tmp.decode('utf-8').split('\n')[0].split(' ')[1])
+        return SystemD._systemd_version
 
     def service_template(self, service):
         if not service.args:
@@ -396,62 +855,72 @@ class SystemD:
         version = self.systemd_version()
         # https://www.freedesktop.org/software/systemd/man/systemd.unit.html
         # https://www.freedesktop.org/software/systemd/man/systemd.service.html
-        tpl = '# created by control.py\n'
-        tpl += '# control.yaml=%s\n' % (service.config.path, )
-        tpl += '\n'
-
-        tpl += '[Unit]\n'
-        tpl += 'Description=%s\n' % (service.config.name +
-                                     '-' + service.name, )
-        tpl += 'After=syslog.target network.target\n'
+        parts = [
+            '# created by control.py\n',
+            '# control.yaml=%s\n' % (service.config.path, ),
+            '\n',
+        ]
+
+        parts.append('[Unit]\n')
+        parts.append('Description=%s\n' % (service.unit_base, ))
+        parts.append('After=syslog.target network.target\n')
         if version > 244:
-            tpl += 'StartLimitIntervalSec=0\n'  # config?
+            parts.append('StartLimitIntervalSec=0\n')  # config?
         else:
-            tpl += 'StartLimitInterval=0\n'  # config?
-        tpl += '\n'
+            parts.append('StartLimitInterval=0\n')  # config?
+        parts.append('\n')
 
-        tpl += '[Service]\n'
-        tpl += 'Type=simple\n'
+        parts.append('[Service]\n')
+        parts.append('Type=simple\n')
         # config?
         if service.type == 'daemon':
-            tpl += 'Restart=on-failure\n'
-            tpl += 'RestartSec=10\n'
+            parts.append('Restart=on-failure\n')
+            parts.append('RestartSec=10\n')
         else:
-            tpl += 'Restart=no\n'
-        tpl += 'StandardOutput=journal\n'
-        tpl += 'StandardError=journal\n'
+            parts.append('Restart=no\n')
+        parts.append('StandardOutput=journal\n')
+        parts.append('StandardError=journal\n')
         if service.syslog:
-            tpl += 'SyslogIdentifier=%s\n' % (service.syslog, )
+            parts.append('SyslogIdentifier=%s\n' % (service.syslog, ))
         else:
-            tpl += 'SyslogIdentifier=%s\n' % (service.config.name +
-                                            '-' + service.name, )
-        tpl += 'User=%s\n' % (service.user or 'root', )
-        tpl += 'ExecStart=%s\n' % (' '.join([shlex.quote(i)
-                                             for i in service.args]), )
-        tpl += 'WorkingDirectory=%s\n' % (os.path.realpath(
-            service.cwd or os.path.dirname(service.config.path)), )
+            parts.append('SyslogIdentifier=%s\n' % (service.unit_base, ))
+        parts.append('User=%s\n' % (service.user or 'root', ))
+        parts.append('ExecStart=%s\n' % (service.exec_start, ))
+        parts.append('WorkingDirectory=%s\n' % (service.working_dir, ))
         if service.env:
-            for (k, v) in service.env.items():
-                tpl += 'Environment=%s=%s\n' % (k, v)
+            parts.extend('Environment=%s=%s\n' % (k, v)
+                         for (k, v) in service.env.items())
         if service.max_cpu is not None:
-            tpl += 'CPUQuota=%s\n' % (service.max_cpu, )
+            parts.append('CPUQuota=%s\n' % (service.max_cpu, ))
         if service.max_memory is not None:
-            tpl += 'MemoryMax=%s\n' % (service.max_memory, )
+            parts.append('MemoryMax=%s\n' % (service.max_memory, ))
         if service.max_time is not None:
-            tpl += 'RuntimeMaxSec=%s\n' % (service.max_time, )
+            parts.append('RuntimeMaxSec=%s\n' % (service.max_time, ))
         if service.nofile is not None:
-            tpl += 'LimitNOFILE=%s\n' % (service.nofile, )
+            parts.append('LimitNOFILE=%s\n' % (service.nofile, ))
         if service.systemd:
-            tpl += service.systemd
+            parts.append(service.systemd)
             if not service.systemd.endswith('\n'):
-                tpl += '\n'
+                parts.append('\n')
 
         if service.type == 'daemon':
-            tpl += '\n'
-            tpl += '[Install]\n'
-            tpl += 'WantedBy=multi-user.target\n'
+            parts.append('\n')
+            parts.append('[Install]\n')
+            parts.append('WantedBy=multi-user.target\n')
 
-        return tpl
+        return ''.join(parts)
+
+    def calendars(self, service):
+        if service.cron is None or service.type != 'cron':
+            return []
+        return service.cron if isinstance(service.cron, list) else [service.cron]
+
+    def check_calendars(self, crons):
+        # systemd-analyze takes any number of expressions, fails if one is invalid
+        crons = [i for i in crons if i not in self._valid_calendars]
+        if crons:
+            subprocess.check_output(['systemd-analyze', 'calendar'] + crons)
+            self._valid_calendars.update(crons)
 
     def timer_template(self, service):
         # https://www.freedesktop.org/software/systemd/man/systemd.timer.html
@@ -460,50 +929,65 @@ class SystemD:
             return None
         if not service.config or not service.config.name:
             raise Exception('config empty')
-        tpl = '# created by control.py\n'
-        tpl += '# control.yaml=%s\n' % (service.config.path, )
-        tpl += '\n'
-        tpl += '[Unit]\n'
-        tpl += 'Description=%s\n' % (service.config.name +
-                                     '-' + service.name, )
-        tpl += '\n'
-        tpl += '[Timer]\n'
+        parts = [
+            '# created by control.py\n',
+            '# control.yaml=%s\n' % (service.config.path, ),
+            '\n',
+        ]
+        parts.append('[Unit]\n')
+        parts.append('Description=%s\n' % (service.unit_base, ))
+        parts.append('\n')
+        parts.append('[Timer]\n')
         if service.interval is not None and service.type == 'periodic':
-            tpl += 'OnActiveSec=%s\n' % (
-                service.first_interval or service.interval, )
-            tpl += 'OnUnitActiveSec=%s\n' % (service.interval, )
+            parts.append('OnActiveSec=%s\n' % (
+                service.first_interval or service.interval, ))
+            parts.append('OnUnitActiveSec=%s\n' % (service.interval, ))
         if service.cron is not None and service.type == 'cron':
-            crons = service.cron if isinstance(service.cron, list) else [service.cron]
+            crons = self.calendars(service)
+            self.check_calendars(crons)
             for cron in crons:
-                subprocess.check_output(['systemd-analyze', 'calendar', cron])
-                tpl += 'OnCalendar=%s\n' % (cron, )
+                parts.append('OnCalendar=%s\n' % (cron, ))
             # Persistent=true
         if service.random_delay is not None:
-            tpl += 'RandomizedDelaySec=%s\n' % (service.random_delay, )
+            parts.append('RandomizedDelaySec=%s\n' % (service.random_delay, ))
         if service.systemd_timer:
-            tpl += service.systemd_timer
+            parts.append(service.systemd_timer)
             if not service.systemd_timer.endswith('\n'):
-                tpl += '\n'
-        tpl += '\n'
-        tpl += '[Install]\n'
-        tpl += 'WantedBy=timers.target\n'
-        return tpl
+                parts.append('\n')
+        parts.append('\n')
+        parts.append('[Install]\n')
+        parts.append('WantedBy=timers.target\n')
+        return ''.join(parts)
 
     def install(self, service):
+        self.install_many([service])
+
+    def write_units(self, service):
+        """Write the unit files for service, returns True if any changed."""
+        changed = False
         tpl = self.service_template(service)
         if tpl:
-            target = os.path.join(
-                self.unit_path, service.config.name + '-' + service.name + '.service')
-            self.file_write(target, tpl)
+            target = os.path.join(self.unit_path, service.unit_service)
+            changed = self.file_write(target, tpl) or changed
 
         tpl = self.timer_template(service)
         if tpl:
-            target = os.path.join(
-                self.unit_path, service.config.name + '-' + service.name + '.timer')
-            self.file_write(target, tpl)
+            target = os.path.join(self.unit_path, service.unit_timer)
+            changed = self.file_write(target, tpl) or changed
+        return changed
+
+    def install_many(self, services):
+        services = _unique(services)
+        if not services:
+            return
+        self.check_calendars(sum([self.calendars(i) for i in services], []))
+        changed = False
+        for service in services:
+            changed = self.write_units(service) or changed
 
-        self.run(['systemctl', 'daemon-reload'])
-        self.enable(service)
+        if changed:
+            self.run(['systemctl', 'daemon-reload'])
+        self.enable_many(services)
 
     def uninstall(self, service):
         try:
@@ -514,85 +998,130 @@ class SystemD:
             self.disable(service)
         except:
             pass
-        target = os.path.join(
-            self.unit_path, service.config.name + '-' + service.name + '.service')
+        target = os.path.join(self.unit_path, service.unit_service)
         self.file_delete(target)
-        target = os.path.join(
-            self.unit_path, service.config.name + '-' + service.name + '.timer')
+        target = os.path.join(self.unit_path, service.unit_timer)
         self.file_delete(target)
 
     def uninstall_all(self, config):
-        for file in os.listdir(self.unit_path):
-            if file.endswith('.timer'):
-                try:
-                    self.file_read(os.path.join(self.unit_path, file)).split(
-                        '\n').index('# control.yaml=' + config.path)
-                except:
-                    continue
-                try:
-                    self.run(['systemctl', 'stop', file])
-                except subprocess.CalledProcessError:
-                    pass
-                try:
-                    self.run(['systemctl', 'disable', file])
-                except subprocess.CalledProcessError:
-                    pass
-                self.file_delete(os.path.join(self.unit_path, file))
-        for file in os.listdir(self.unit_path):
-            if file.endswith('.service'):
-                try:
-                    self.file_read(os.path.join(self.unit_path, file)).split(
-                        '\n').index('# control.yaml=' + config.path)
-                except:
+        marker = '# control.yaml=' + config.path + '\n'
+        prefix = config.name + '-'
+        timers = []
+        services = []
+        with os.scandir(self.unit_path) as it:
+            for entry in it:
+                # all units we create are named <config>-<service>
+                if not entry.name.startswith(prefix) or not entry.is_file():
                     continue
-                try:
-                    self.run(['systemctl', 'stop', file])
-                except subprocess.CalledProcessError:
-                    pass
-                try:
-                    self.run(['systemctl', 'disable', file])
-                except subprocess.CalledProcessError:
-                    pass
-                self.file_delete(os.path.join(self.unit_path, file))
+                if entry.name.endswith('.timer'):
+                    timers.append(entry)
+                elif entry.name.endswith('.service'):
+                    services.append(entry)
+        owned = []
+        # timers first so they cannot trigger a service that is being removed
+        for entry in timers + services:
+            try:
+                if marker in self.file_read(entry.path):
+                    owned.append(entry)
+            except:
+                pass
+        if not owned:
+            return
+        units = [i.name for i in owned]
+        try:
+            self.run(['systemctl', 'stop'] + units)
+        except subprocess.CalledProcessError:
+            pass
+        try:
+            self.run(['systemctl', 'disable'] + units)
+        except subprocess.CalledProcessError:
+            pass
+        for entry in owned:
+            self.file_delete(entry.path)
 
     def start(self, service):
-        if self.is_started(service):
+        self.start_many([service])
+
+    def start_many(self, services):
+        # systemctl start is a no-op for units that are already running
+        services = _unique(services)
+        if not services:
             return
-        print('start', service.name)
+        units = []
+        for service in services:
+            print('start', service.name)
+            units.append(service.unit_service)
         try:
-            self.run(['systemctl', 'start', service.config.name +
-                      '-' + service.name + '.service'])
-            time.sleep(1)
-            self.run(['systemctl', 'is-active', service.config.name +
-                      '-' + service.name + '.service'], silent=True)
+            self.run(['systemctl', 'start'] + units)
+            started = self.wait_active(units)
         except subprocess.CalledProcessError:
+            started = False
+        if not started:
             try:
-                self.run(['systemctl', 'status', service.config.name +
-                          '-' + service.name + '.service'])
+                self.run(['systemctl', 'status'] + units)
             except subprocess.CalledProcessError:
                 pass
 
+    def wait_active(self, units, timeout=1):
+        """Check units twice within timeout seconds, False if any is not active.
+
+        Type=simple units are active as soon as they are forked, so the final
+        check waits the whole timeout to catch services that die right after
+        starting. An early check gives up sooner on units that already failed.
+        """
+        for delay in (timeout / 4.0, timeout * 3 / 4.0):
+            time.sleep(delay)
+            states = self.query(['systemctl', 'is-active'] + units, len(units)).split()
+            if any(i not in ('active', 'activating', 'reloading') for i in states):
+                return False
+        return all(i == 'active' for i in states)
+
     def stop(self, service):
-        if not self.is_started(service):
+        self.stop_many([service])
+
+    def stop_many(self, services):
+        # systemctl stop is a no-op for units that are not running
+        services = _unique(services)
+        if not services:
             return
-        print('stop', service.name)
-        self.run(['systemctl', 'stop', service.config.name +
-                  '-' + service.name + '.service'])
+        units = []
+        for service in services:
+            print('stop', service.name)
+            units.append(service.unit_service)
+        try:
+            self.run(['systemctl', 'stop'] + units)
+        except subprocess.CalledProcessError as e:
+            # 5: some unit is not loaded (not installed), nothing to stop there
+            if e.returncode != 5:
+                raise e
 
     def restart(self, service):
-        print('restart', service.name)
-        self.run(['systemctl', 'restart', service.config.name +
-                  '-' + service.name + '.service'])
+        self.restart_many([service])
+
+    def restart_many(self, services):
+        services = _unique(services)
+        units = []
+        for service in services:
+            print('restart', service.name)
+            units.append(service.unit_service)
+        if units:
+            self.run(['systemctl', 'restart'] + units)
 
     def reload(self, service):
-        print('reload', service.name)
-        self.run(['systemctl', 'reload', service.config.name +
-                  '-' + service.name + '.service'])
+        self.reload_many([service])
+
+    def reload_many(self, services):
+        services = _unique(services)
+        units = []
+        for service in services:
+            print('reload', service.name)
+            units.append(service.unit_service)
+        if units:
+            self.run(['systemctl', 'reload'] + units)
 
     def is_started(self, service):
         try:
-            self.run(['systemctl', 'is-active', service.config.name +
-                      '-' + service.name + '.service'], silent=True)
+            self.run(['systemctl', 'is-active', service.unit_service], silent=True)
             return True
         except subprocess.CalledProcessError as e:
             if e.returncode == 3:
@@ -600,52 +1129,106 @@ class SystemD:
             raise e
 
     def enable(self, service):
-        if self.is_enabled(service):
-            return
-        print('enable', service.name)
-        if service.type == 'daemon':
-            self.run(['systemctl', 'enable', service.config.name +
-                      '-' + service.name + '.service'])
-        elif service.type == 'periodic' or service.type == 'cron':
-            self.run(['systemctl', 'enable', service.config.name +
-                      '-' + service.name + '.timer'])
-            self.run(['systemctl', 'start', service.config.name +
-                      '-' + service.name + '.timer'])
+        self.enable_many([service])
+
+    def enable_many(self, services):
+        # enabling (and starting the timer) again is harmless, no need to check first
+        services = _unique(services)
+        units = []
+        timers = []
+        for service in services:
+            if service.type == 'daemon':
+                print('enable', service.name)
+                units.append(service.unit_service)
+            elif service.type == 'periodic' or service.type == 'cron':
+                print('enable', service.name)
+                timers.append(service.unit_timer)
+        if units:
+            self.run(['systemctl', 'enable'] + units)
+        if timers:
+            self.run(['systemctl', 'enable'] + timers)
+            self.run(['systemctl', 'start'] + timers)
 
     def disable(self, service):
-        if not self.is_enabled(service):
-            return
-        print('disable', service.name)
-        if service.type == 'daemon':
-            self.run(['systemctl', 'disable', service.config.name +
-                      '-' + service.name + '.service'])
-        elif service.type == 'periodic' or service.type == 'cron':
-            self.run(['systemctl', 'stop', service.config.name +
-                      '-' + service.name + '.timer'])
-            self.run(['systemctl', 'disable', service.config.name +
-                      '-' + service.name + '.timer'])
+        self.disable_many([service])
+
+    def disable_many(self, services):
+        services = _unique(services)
+        enabled = self.enabled_many(services)
+        services = [i for i in services if enabled[i.name]]
+        units = []
+        timers = []
+        for service in services:
+            print('disable', service.name)
+            if service.type == 'daemon':
+                units.append(service.unit_service)
+            elif service.type == 'periodic' or service.type == 'cron':
+                timers.append(service.unit_timer)
+        if units:
+            self.run(['systemctl', 'disable'] + units)
+        if timers:
+            self.run(['systemctl', 'stop'] + timers)
+            self.run(['systemctl', 'disable'] + timers)
 
     def is_enabled(self, service):
         try:
             if service.type == 'daemon':
-                self.run(['systemctl', 'is-enabled', service.config.name +
-                          '-' + service.name + '.service'], silent=True)
+                self.run(['systemctl', 'is-enabled', service.unit_service], silent=True)
             elif service.type == 'periodic' or service.type == 'cron':
-                self.run(['systemctl', 'is-enabled', service.config.name +
-                          '-' + service.name + '.timer'], silent=True)
+                self.run(['systemctl', 'is-enabled', service.unit_timer], silent=True)
             return True
         except subprocess.CalledProcessError as e:
             if e.returncode == 1:
                 return False
             raise e
 
+    def started_many(self, services):
+        """Return {name: started} using a single systemctl is-active."""
+        res = dict((i.name, False) for i in services)
+        if not res:
+            return res
+        tmp = self.query(['systemctl', 'is-active'] + [i.unit_service for i in services],
+                         len(services))
+        for (service, state) in zip(services, tmp.splitlines()):
+            res[service.name] = state in ('active', 'reloading')
+        return res
+
+    def enabled_many(self, services):
+        """Return {name: enabled} using a single systemctl list-unit-files."""
+        # like is_enabled(), services without an install target count as enabled
+        res = dict((i.name, True) for i in services)
+        install_units = {}
+        for service in services:
+            if service.type == 'daemon':
+                install_units[service.unit_service] = service.name
+            elif service.type == 'periodic' or service.type == 'cron':
+                install_units[service.unit_timer] = service.name
+        if not install_units:
+            return res
+        for name in install_units.values():
+            res[name] = False
+        tmp = self.query(['systemctl', 'list-unit-files', '--no-legend', '--no-pager'] +
+                         list(install_units.keys()))
+        for line in tmp.splitlines():
+            cols = line.split()
+            if len(cols) >= 2 and cols[0] in install_units:
+                res[install_units[cols[0]]] = cols[1] in _ENABLED_STATES
+        return res
+
+    def bulk_state(self, services):
+        """Return {name: (enabled, started)} with one systemctl call per state."""
+        services = _unique(services)
+        enabled = self.enabled_many(services)
+        started = self.started_many(services)
+        return dict((i.name, (enabled[i.name], started[i.name])) for i in services)
+
 
 class Commands:
     def __init__(self, config):
         self.config = config
 
     def dump(self):
-        print(yaml.dump(self.config.to_dict()))
+        print(yaml.dump(self.config.to_full_dict(), Dumper=_Dumper))
 
     def prefix(self):
         print(self.config.name)
@@ -674,35 +1257,31 @@ class Commands:
 
     def install(self, names):
         backend = SystemD()
-        for service in self.config.get_services(names):
-            backend.install(service)
+        with backend.batch():
+            backend.install_many(list(self.config.get_services(names)))
 
     def uninstall(self, names):
         backend = SystemD()
         if len(names) == 0:
             backend.uninstall_all(self.config)
-        for service in self.config.get_services(names):
+        for service in _unique(self.config.get_services(names)):
             backend.uninstall(service)
 
     def start(self, names):
         backend = SystemD()
-        for service in self.config.get_services(names):
-            backend.start(service)
+        backend.start_many(list(self.config.get_services(names)))
 
     def stop(self, names):
         backend = SystemD()
-        for service in self.config.get_services(names):
-            backend.stop(service)
+        backend.stop_many(list(self.config.get_services(names)))
 
     def restart(self, names):
         backend = SystemD()
-        for service in self.config.get_services(names):
-            backend.restart(service)
+        backend.restart_many(list(self.config.get_services(names)))
 
     def reload(self, names):
         backend = SystemD()
-        for service in self.config.get_services(names):
-            backend.reload(service)
+        backend.reload_many(list(self.config.get_services(names)))
 
     def is_started(self, name):
         backend = SystemD()
@@ -711,13 +1290,11 @@ class Commands:
 
     def enable(self, names):
         backend = SystemD()
-        for service in self.config.get_services(names):
-            backend.enable(service)
+        backend.enable_many(list(self.config.get_services(names)))
 
     def disable(self, names):
         backend = SystemD()
-        for service in self.config.get_services(names):
-            backend.disable(service)
+        backend.disable_many(list(self.config.get_services(names)))
 
     def is_enabled(self, name):
         backend = SystemD()
@@ -728,16 +1305,19 @@ class Commands:
         if len(names) == 0:
             names = 'all'
         backend = SystemD()
-        for service in sorted(self.config.get_services(names), key=lambda i: i.name):
+        services = sorted(_unique(self.config.get_services(names)), key=lambda i: i.name)
+        state = backend.bulk_state(services)
+        for service in services:
+            (enabled, started) = state[service.name]
             print('{:30s} {:10s} {:10s}'.format(
                 service.name,
-                'enabled' if backend.is_enabled(service) else 'disabled',
-                'running' if backend.is_started(service) else 'stopped'
+                'enabled' if enabled else 'disabled',
+                'running' if started else 'stopped'
             ))
             if full:
                 try:
                     backend.run(['systemctl', '--no-pager', '--no-ask-password',
-                                 'status', service.config.name + '-' + service.name])
+                                 'status', service.unit_base])
                 except subprocess.CalledProcessError:
                     pass
 
@@ -746,41 +1326,42 @@ class Commands:
             names = 'all'
         backend = SystemD()
         res_services = {}
-        for service in sorted(self.config.get_services(names), key=lambda i: i.name):
+        services = sorted(_unique(self.config.get_services(names)), key=lambda i: i.name)
+        state = backend.bulk_state(services)
+        for service in services:
+            (enabled, started) = state[service.name]
             res_service = {
                 'name': service.name,
-                'enabled': backend.is_enabled(service),
-                'started': backend.is_started(service),
+                'enabled': enabled,
+                'started': started,
             }
             res_services[service.name] = res_service
             # if True:
             #     try:
-            #         backend.run(['systemctl', '--no-pager', '--no-ask-password', 'show', service.config.name + '-' + service.name])
+            #         backend.run(['systemctl', '--no-pager', '--no-ask-password', 'show', service.unit_base])
             #     except subprocess.CalledProcessError:
             #         pass
         print(json.dumps(res_services))
 
     def log(self, names, follow=False):
         backend = SystemD()
+        # one journalctl multiplexes all units
+        args = ['journalctl', '--no-pager']
+        for service in _unique(self.config.get_services(names)):
+            args += ['-u', service.unit_base]
+        if '-u' not in args:
+            return
         if follow:
-            procs = []
-            for service in self.config.get_services(names):
-                args = ['journalctl', '--no-pager', '-f', '-u',
-                        service.config.name + '-' + service.name]
-                if os.getuid() != 0:
-                    args = ['sudo', '-n'] + args
-                procs.append(subprocess.Popen(args))
-            if len(procs) > 0:
-                procs[0].wait()
-            for proc in procs:
+            args.insert(2, '-f')
+            proc = backend.popen(args)
+            try:
+                proc.wait()
+            except KeyboardInterrupt:
                 proc.terminate()
-            for proc in procs:
                 proc.wait()
 
         else:
-            for service in self.config.get_services(names):
-                backend.run(['journalctl', '--no-pager', '-u',
-                             service.config.name + '-' + service.name])
+            backend.run(args)
 
 
 if True:
@@ -824,6 +1405,40 @@ if False:
     Service.from_dict = new_from_dict
 
 
+# subcommands that only take service names: (name, help, nargs, method)
+_NAME_COMMANDS = [
+    ('run', 'run service', None, 'run'),
+    ('install', 'install service', '+', 'install'),
+    ('uninstall', 'uninstall service', '*', 'uninstall'),
+    ('start', 'start service', '+', 'start'),
+    ('stop', 'stop service', '+', 'stop'),
+    ('restart', 'restart service', '+', 'restart'),
+    ('reload', 'reload service', '+', 'reload'),
+    ('is-started', 'check if service is started', None, 'is_started'),
+    ('enable', 'enable service', '+', 'enable'),
+    ('disable', 'disable service', '+', 'disable'),
+    ('is-enabled', 'check if service is enabled', None, 'is_enabled'),
+]
+
+_COMMAND_NAMES = frozenset(['dump', 'prefix', 'status', 'json', 'log'] +
+                           [i[0] for i in _NAME_COMMANDS])
+
+
+def _peek_command(argv):
+    """Return the subcommand in argv if it is a known one, else None."""
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--config':
+            skip = True
+        elif arg in ('-h', '--help'):
+            return None
+        elif not arg.startswith('-'):
+            return arg if arg in _COMMAND_NAMES else None
+    return None
+
+
 def main():
     import argparse
 
@@ -837,84 +1452,39 @@ def main():
                             default=False, help='verbose mode')
     mainparser.add_argument(
         '--config', default='control.yaml', help='path to config file')
+    mainparser.add_argument('--no-validate', action='store_true', default=False,
+                            help='skip schema validation of a trusted config file')
     subparsers = mainparser.add_subparsers()
 
     config = None
     commands = None
 
-    if True:
+    # only build the subparser that will be used, all of them for help/errors
+    command = _peek_command(sys.argv[1:])
+
+    def want(name):
+        return command is None or command == name
+
+    if want('dump'):
         parser = subparsers.add_parser(
             'dump', help='dump parsed configuration')
         parser.set_defaults(func=lambda args: commands.dump())
 
-    if True:
+    if want('prefix'):
         parser = subparsers.add_parser('prefix', help='print prefix/name')
         parser.set_defaults(func=lambda args: commands.prefix())
 
-    if True:
-        parser = subparsers.add_parser('run', help='run service')
-        parser.add_argument('name', help='name of service')
-        parser.set_defaults(func=lambda args: commands.run(name=args.name))
-
-    if True:
-        parser = subparsers.add_parser('install', help='install service')
-        parser.add_argument('name', nargs='+', help='name of service')
-        parser.set_defaults(
-            func=lambda args: commands.install(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser('uninstall', help='uninstall service')
-        parser.add_argument('name', nargs='*', help='name of service')
-        parser.set_defaults(
-            func=lambda args: commands.uninstall(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser('start', help='start service')
-        parser.add_argument('name', nargs='+', help='name of service')
-        parser.set_defaults(func=lambda args: commands.start(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser('stop', help='stop service')
-        parser.add_argument('name', nargs='+', help='name of service')
-        parser.set_defaults(func=lambda args: commands.stop(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser('restart', help='restart service')
-        parser.add_argument('name', nargs='+', help='name of service')
-        parser.set_defaults(
-            func=lambda args: commands.restart(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser('reload', help='reload service')
-        parser.add_argument('name', nargs='+', help='name of service')
-        parser.set_defaults(func=lambda args: commands.reload(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser(
-            'is-started', help='check if service is started')
-        parser.add_argument('name', help='name of service')
-        parser.set_defaults(
-            func=lambda args: commands.is_started(name=args.name))
-
-    if True:
-        parser = subparsers.add_parser('enable', help='enable service')
-        parser.add_argument('name', nargs='+', help='name of service')
-        parser.set_defaults(func=lambda args: commands.enable(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser('disable', help='disable service')
-        parser.add_argument('name', nargs='+', help='name of service')
-        parser.set_defaults(
-            func=lambda args: commands.disable(names=args.name))
-
-    if True:
-        parser = subparsers.add_parser(
-            'is-enabled', help='check if service is enabled')
-        parser.add_argument('name', help='name of service')
-        parser.set_defaults(
-            func=lambda args: commands.is_enabled(name=args.name))
-
-    if True:
+    for (name, helpmsg, nargs, method) in _NAME_COMMANDS:
+        if not want(name):
+            continue
+        parser = subparsers.add_parser(name, help=helpmsg)
+        parser.add_argument('name', nargs=nargs, help='name of service')
+        # single names are passed as name=, lists as names=
+        key = 'name' if nargs is None else 'names'
+        parser.set_defaults(func=lambda args, method=method, key=key: getattr(
+            commands, method)(**{key: args.name}))
+
+    if want('status'):
         parser = subparsers.add_parser(
             'status', help='list services and status')
         parser.add_argument('name', nargs='*', help='name of service')
@@ -923,14 +1493,14 @@ def main():
         parser.set_defaults(func=lambda args: commands.status(
             names=args.name, full=args.full))
 
-    if True:
+    if want('json'):
         parser = subparsers.add_parser(
             'json', help='list services and status as json')
         parser.add_argument('name', nargs='*', help='name of service')
         parser.set_defaults(
             func=lambda args: commands.status_json(names=args.name))
 
-    if True:
+    if want('log'):
         parser = subparsers.add_parser('log', help='show logs')
         parser.add_argument('name', nargs='*', help='name of service')
         parser.add_argument(
@@ -948,6 +1518,10 @@ def main():
     else:
         logging.basicConfig(level=logging.WARNING)
 
+    if args.no_validate:
+        global _VALIDATE
+        _VALIDATE = False
+
     config = Config.load(args.config)
     commands = Commands(config)
 